@@ -1,16 +1,44 @@
-import time
+import json
+import hashlib
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from streamlit_autorefresh import st_autorefresh
 
 # =========================================================
 # CONFIG
 # =========================================================
 SERVER = "https://drns-1.onrender.com"
 REFRESH_SEC = 2
+MAX_BACKOFF_SEC = 30
+
+MAP_ZOOM = 11
+# above this many UAVs the map shows grid clusters instead of single points
+# (clusters are fixed at MAP_ZOOM, so keep this where WebGL actually struggles)
+CLUSTER_MIN_POINTS = 10000
+# ~40 px cells at MAP_ZOOM (256 px tiles, 360 deg per tile at zoom 0)
+CLUSTER_CELL_DEG = 40 * 360 / (256 * 2 ** MAP_ZOOM)
+# longer analysis series are downsampled (LTTB) to this many points
+LTTB_MAX_POINTS = 2000
+
+colors = {
+    "safe": "blue",
+    "outer_near": "gold",
+    "inner_near": "orange",
+    "collision": "red"
+}
+
+# fixed category order: codes 0..3 follow the colors table
+STATUS_CAT = pd.CategoricalDtype(list(colors))
+SAFE, OUTER, INNER, COLLISION = range(4)
+STATUS_COLORS = np.array(list(colors.values()))
 
 st.set_page_config(page_title="UAV Dashboard", layout="wide")
 
@@ -40,45 +68,148 @@ st.markdown(
 )
 
 # =========================================================
-# FETCH DATA
+# AUTO REFRESH (browser-side timer, armed before the fetch so fetch
+# latency does not stretch the refresh period)
+# =========================================================
+# back off 2 -> 4 -> 8 -> ... -> 30 s while the server is unreachable
+fail_streak = st.session_state.get("fail_streak", 0)
+st_autorefresh(interval=min(REFRESH_SEC * 2 ** fail_streak, MAX_BACKOFF_SEC) * 1000, key="tick")
+
+# =========================================================
+# FETCH DATA -> DATAFRAME
 # =========================================================
-@st.cache_data(ttl=2)
+def to_df(data):
+    # column-wise build: one ndarray per field, no per-row dicts
+    uavs = data["uavs"]
+    n = len(uavs)
+
+    def floats(get):
+        return np.fromiter((get(u) for u in uavs), dtype=np.float64, count=n)
+
+    return pd.DataFrame({
+        "UAV_ID": [u["uav_id"] for u in uavs],
+        "X": floats(lambda u: u["x"]),              # longitude
+        "Y": floats(lambda u: u["y"]),              # latitude
+        # unknown statuses become NaN (code -1)
+        "Status": pd.Categorical([u["status"] for u in uavs], dtype=STATUS_CAT),
+        "dmin": floats(lambda u: u["min_distance_km"]),
+        "PredX": floats(lambda u: u["predicted"]["x"] if u.get("predicted") else np.nan),
+        "PredY": floats(lambda u: u["predicted"]["y"] if u.get("predicted") else np.nan)
+    })
+
+def parse_json(raw):
+    # orjson rejects NaN / Infinity tokens (e.g. an unbounded min_distance_km
+    # from a Python server); the stdlib parser accepts them
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return json.loads(raw)
+
+@st.cache_resource
+def http_session():
+    # shared across reruns -> keep-alive, no TCP/TLS handshake per refresh
+    s = requests.Session()
+    # reconnect after a dropped keep-alive; never re-wait a slow read
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    return s
+
+@st.cache_data(ttl=REFRESH_SEC)
 def fetch_data():
-    before = requests.get(SERVER + "/uavs?process=false", timeout=20).json()
-    after  = requests.get(SERVER + "/uavs?process=true",  timeout=20).json()
-    return before, after
+    session = http_session()
+    # both endpoints in flight at once: wait ~max(RTT), not the sum
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fB = ex.submit(session.get, SERVER + "/uavs?process=false", timeout=20)
+        fA = ex.submit(session.get, SERVER + "/uavs?process=true",  timeout=20)
+        rawB = fB.result().content
+        rawA = fA.result().content
+    # identifies this exact server state; keys the figure caches below
+    digest = hashlib.blake2b(rawB + b"\0" + rawA, digest_size=8).hexdigest()
+    return digest, to_df(parse_json(rawB)), to_df(parse_json(rawA))
 
 try:
-    data_before, data_after = fetch_data()
+    digest, dfB, dfA = fetch_data()
+    st.session_state["fail_streak"] = 0
 except Exception as e:
-    st.error(f"Server connection failed: {e}")
+    st.session_state["fail_streak"] = fail_streak + 1
+    wait = min(REFRESH_SEC * 2 ** fail_streak, MAX_BACKOFF_SEC)
+    st.error(f"Server connection failed: {e} (retrying in {wait}s)")
     st.stop()
 
 # =========================================================
-# TO DATAFRAME
+# PLOT HELPERS
+# (per-UAV work is column-wise on .to_numpy() arrays: no row loops,
+#  no iterrows; only the status / bucket tables are iterated)
 # =========================================================
-def to_df(data):
-    rows = []
-    for u in data["uavs"]:
-        rows.append({
-            "UAV_ID": u["uav_id"],
-            "X": u["x"],              # longitude
-            "Y": u["y"],              # latitude
-            "Status": u["status"],
-            "dmin": u["min_distance_km"],
-            "PredX": u["predicted"]["x"] if u.get("predicted") else np.nan,
-            "PredY": u["predicted"]["y"] if u.get("predicted") else np.nan
-        })
-    return pd.DataFrame(rows)
-
-dfB = to_df(data_before)
-dfA = to_df(data_after)
+HOVER_XY  = "UAV %{customdata[0]}<br>%{customdata[1]}<br>(%{x:.5f}, %{y:.5f})<extra></extra>"
+HOVER_MAP = "UAV %{customdata[0]}<br>%{customdata[1]}<br>(%{lon:.5f}, %{lat:.5f})<extra></extra>"
+
+def status_points(df):
+    # one trace per panel: color comes per point, unknown statuses are dropped
+    codes = df["Status"].cat.codes.to_numpy()
+    keep = codes >= 0
+    return df[keep], STATUS_COLORS[codes[keep]]
+
+def status_counts(df):
+    # UAVs per status in colors order; unknown statuses (code -1) are skipped
+    codes = df["Status"].cat.codes.to_numpy()
+    return np.bincount(codes[codes >= 0], minlength=len(colors))
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: indices of n_out points that keep the shape
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < len(edges) else n
+        bx, by = x[hi:nhi].mean(), y[hi:nhi].mean()
+        area = np.abs((x[a] - bx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (by - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+def thin(x, y):
+    # constant-size series for plotting, whatever the fleet size
+    keep = lttb(x, y, LTTB_MAX_POINTS)
+    return x[keep], y[keep]
+
+def cluster_points(df):
+    # grid clusters at MAP_ZOOM: centroid, size, most severe status and the
+    # IDs of colliding UAVs per cell
+    x = df["X"].to_numpy()
+    y = df["Y"].to_numpy()
+    codes = df["Status"].cat.codes.to_numpy()
+    cells = np.floor(np.column_stack([x, y]) / CLUSTER_CELL_DEG)
+    _, inv, n = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inv = inv.ravel()
+    worst = np.zeros(len(n), dtype=np.int8)
+    np.maximum.at(worst, inv, codes)
+    lat = np.bincount(inv, weights=y) / n
+    lon = np.bincount(inv, weights=x) / n
+
+    collisions = np.full(len(n), "", dtype=object)
+    coll = codes == COLLISION
+    if coll.any():
+        order = np.argsort(inv[coll], kind="stable")
+        cell = inv[coll][order]
+        ids = df["UAV_ID"].to_numpy()[coll][order].astype(str)
+        starts = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]])
+        for k, grp in zip(cell[starts], np.split(ids, starts[1:])):
+            collisions[k] = "<br>collision: " + ", ".join(grp)
+    return lat, lon, n, worst, collisions
 
 # =========================================================
 # COLLISION ALERT
 # =========================================================
-collision_df = dfA[dfA["Status"] == "collision"]
-collision_count = len(collision_df)
+# one count per frame, shared by the alert, the bars and both legends
+countsB = status_counts(dfB)
+countsA = status_counts(dfA)
+collision_count = int(countsA[COLLISION])
 
 if collision_count > 0:
     st.error(f"🚨 COLLISION ALERT: {collision_count} UAV(s) detected!")
@@ -88,169 +219,234 @@ else:
 # =========================================================
 # ===== TOP ROW : 4 MAIN PLOTS =====
 # =========================================================
-colors = {
-    "safe": "blue",
-    "outer_near": "gold",
-    "inner_near": "orange",
-    "collision": "red"
-}
-
-fig_top = make_subplots(
-    rows=1, cols=4,
-    subplot_titles=[
-        "BEFORE – Raw Positions",
-        "Prediction",
-        "AFTER – Avoidance",
-        "Status Distribution"
-    ]
-)
-
-# BEFORE
-for s in colors:
-    d = dfB[dfB["Status"] == s]
-    fig_top.add_trace(
-        go.Scatter(
-            x=d["X"], y=d["Y"],
-            mode="markers",
-            marker=dict(size=8, symbol="circle-open", color=colors[s]),
-            name=f"BEFORE {s}"
-        ),
-        row=1, col=1
+@st.cache_resource(max_entries=4)
+def top_figure(digest, _dfB, _dfA, _countsB, _countsA):
+    # rebuilt only when the payload digest changes; treated as read-only
+    fig_top = make_subplots(
+        rows=1, cols=4,
+        subplot_titles=[
+            "BEFORE – Raw Positions",
+            "Prediction",
+            "AFTER – Avoidance",
+            "Status Distribution"
+        ]
     )
 
-# PREDICTION
-valid = dfB["PredX"].notna()
-fig_top.add_trace(go.Scatter(
-    x=dfB[valid]["X"], y=dfB[valid]["Y"],
-    mode="markers",
-    marker=dict(size=7, symbol="circle-open", color="black"),
-    name="Before"
-), row=1, col=2)
-
-fig_top.add_trace(go.Scatter(
-    x=dfB[valid]["PredX"], y=dfB[valid]["PredY"],
-    mode="markers",
-    marker=dict(size=8, symbol="circle-open", color="magenta"),
-    name="Predicted"
-), row=1, col=2)
-
-# AFTER
-for s in colors:
-    d = dfA[dfA["Status"] == s]
-    fig_top.add_trace(
-        go.Scatter(
-            x=d["X"], y=d["Y"],
-            mode="markers",
-            marker=dict(size=8, symbol="circle-open", color=colors[s]),
-            name=f"AFTER {s}"
-        ),
-        row=1, col=3
+    # BEFORE
+    d, c = status_points(_dfB)
+    fig_top.add_trace(go.Scattergl(
+        x=d["X"].to_numpy(), y=d["Y"].to_numpy(),
+        mode="markers",
+        marker=dict(size=8, symbol="circle-open", color=c),
+        customdata=d[["UAV_ID", "Status"]].to_numpy(),
+        hovertemplate=HOVER_XY,
+        name="BEFORE",
+        showlegend=False
+    ), row=1, col=1)
+
+    # PREDICTION
+    p = _dfB[_dfB["PredX"].notna().to_numpy()]
+    fig_top.add_trace(go.Scattergl(
+        x=p["X"].to_numpy(), y=p["Y"].to_numpy(),
+        mode="markers",
+        marker=dict(size=7, symbol="circle-open", color="black"),
+        name="Before"
+    ), row=1, col=2)
+
+    fig_top.add_trace(go.Scattergl(
+        x=p["PredX"].to_numpy(), y=p["PredY"].to_numpy(),
+        mode="markers",
+        marker=dict(size=8, symbol="circle-open", color="magenta"),
+        name="Predicted"
+    ), row=1, col=2)
+
+    # AFTER
+    d, c = status_points(_dfA)
+    fig_top.add_trace(go.Scattergl(
+        x=d["X"].to_numpy(), y=d["Y"].to_numpy(),
+        mode="markers",
+        marker=dict(size=8, symbol="circle-open", color=c),
+        customdata=d[["UAV_ID", "Status"]].to_numpy(),
+        hovertemplate=HOVER_XY,
+        name="AFTER",
+        showlegend=False
+    ), row=1, col=3)
+
+    # STATUS LEGEND (legend-only entries for the statuses present)
+    for i, (s, col) in enumerate(colors.items()):
+        if _countsB[i] or _countsA[i]:
+            fig_top.add_trace(go.Scattergl(
+                x=[None], y=[None],
+                mode="markers",
+                marker=dict(size=8, symbol="circle-open", color=col),
+                name=s,
+                hoverinfo="skip"
+            ), row=1, col=1)
+
+    # STATUS DISTRIBUTION
+    labels = list(colors.keys())
+    fig_top.add_trace(go.Bar(
+        x=labels,
+        y=_countsB,
+        name="Before",
+        hoverinfo="skip"
+    ), row=1, col=4)
+
+    fig_top.add_trace(go.Bar(
+        x=labels,
+        y=_countsA,
+        name="After",
+        hoverinfo="skip"
+    ), row=1, col=4)
+
+    fig_top.update_layout(
+        height=360,
+        barmode="group",
+        margin=dict(l=10, r=10, t=40, b=10),
+        legend=dict(orientation="h", y=-0.28)
     )
 
-# STATUS DISTRIBUTION
-labels = list(colors.keys())
-fig_top.add_trace(go.Bar(
-    x=labels,
-    y=[sum(dfB["Status"] == s) for s in labels],
-    name="Before"
-), row=1, col=4)
-
-fig_top.add_trace(go.Bar(
-    x=labels,
-    y=[sum(dfA["Status"] == s) for s in labels],
-    name="After"
-), row=1, col=4)
-
-fig_top.update_layout(
-    height=360,
-    barmode="group",
-    margin=dict(l=10, r=10, t=40, b=10),
-    legend=dict(orientation="h", y=-0.28)
-)
+    return fig_top
 
-st.plotly_chart(fig_top, use_container_width=True)
+st.plotly_chart(top_figure(digest, dfB, dfA, countsB, countsA), use_container_width=True, key="top")
 
 # =========================================================
 # ===== SECOND ROW : 3 ANALYSIS PLOTS =====
 # =========================================================
-dmin_before = dfB["dmin"].values
-dmin_after  = dfA["dmin"].values
-delta_dmin  = dmin_after - dmin_before
+@st.cache_resource(max_entries=4)
+def analysis_figures(digest, _dfB, _dfA):
+    # align BEFORE/AFTER by UAV_ID: the two responses need not share row order
+    M = _dfB.merge(_dfA[["UAV_ID", "dmin"]], on="UAV_ID", suffixes=("_B", "_A"))
+
+    dmin_before = M["dmin_B"].to_numpy()
+    dmin_after  = M["dmin_A"].to_numpy()
+    delta_dmin  = dmin_after - dmin_before
+
+    # only UAVs with a prediction; x keeps their index in M
+    pred_idx  = np.flatnonzero(M["PredX"].notna().to_numpy())
+    pred_move = np.hypot(
+        M["PredX"].to_numpy() - M["X"].to_numpy(),
+        M["PredY"].to_numpy() - M["Y"].to_numpy()
+    )[pred_idx]
+
+    uav_idx = np.arange(len(M))
+
+    # Predicted displacement (Line + Markers)
+    x, y = thin(pred_idx, pred_move)
+    fig1 = go.Figure()
+    fig1.add_trace(go.Scatter(
+        x=x, y=y,
+        mode="lines+markers",
+        line=dict(width=2, color="blue"),
+        marker=dict(size=7, symbol="circle-open")
+    ))
+    fig1.update_layout(
+        title="Predicted Displacement",
+        xaxis_title="UAV Index",
+        yaxis_title="Predicted Displacement (km)",
+        height=260
+    )
 
-pred_move = np.sqrt(
-    (dfB["PredX"] - dfB["X"])**2 +
-    (dfB["PredY"] - dfB["Y"])**2
-)
+    # Delta dmin
+    x, y = thin(uav_idx, delta_dmin)
+    fig2 = go.Figure()
+    fig2.add_trace(go.Bar(x=x, y=y))
+    fig2.update_layout(
+        title="Δ dmin",
+        xaxis_title="UAV Index",
+        yaxis_title="Δ Minimum Distance (km)",
+        height=260
+    )
 
-# Predicted displacement (Line + Markers)
-fig1 = go.Figure()
-fig1.add_trace(go.Scatter(
-    y=pred_move,
-    mode="lines+markers",
-    line=dict(width=2, color="blue"),
-    marker=dict(size=7, symbol="circle-open")
-))
-fig1.update_layout(
-    title="Predicted Displacement",
-    xaxis_title="UAV Index",
-    yaxis_title="Predicted Displacement (km)",
-    height=260
-)
+    # dmin before vs after
+    fig3 = go.Figure()
+    x, y = thin(uav_idx, dmin_before)
+    fig3.add_trace(go.Scatter(x=x, y=y, mode="lines+markers", name="Before"))
+    x, y = thin(uav_idx, dmin_after)
+    fig3.add_trace(go.Scatter(x=x, y=y, mode="lines+markers", name="After"))
+    fig3.update_layout(
+        title="dmin Before vs After",
+        xaxis_title="UAV Index",
+        yaxis_title="Minimum Distance (km)",
+        height=260
+    )
 
-# Delta dmin
-fig2 = go.Figure()
-fig2.add_trace(go.Bar(y=delta_dmin))
-fig2.update_layout(
-    title="Δ dmin",
-    xaxis_title="UAV Index",
-    yaxis_title="Δ Minimum Distance (km)",
-    height=260
-)
+    return fig1, fig2, fig3
 
-# dmin before vs after
-fig3 = go.Figure()
-fig3.add_trace(go.Scatter(y=dmin_before, mode="lines+markers", name="Before"))
-fig3.add_trace(go.Scatter(y=dmin_after,  mode="lines+markers", name="After"))
-fig3.update_layout(
-    title="dmin Before vs After",
-    xaxis_title="UAV Index",
-    yaxis_title="Minimum Distance (km)",
-    height=260
-)
+fig1, fig2, fig3 = analysis_figures(digest, dfB, dfA)
 
 c1, c2, c3 = st.columns(3)
-with c1: st.plotly_chart(fig1, use_container_width=True)
-with c2: st.plotly_chart(fig2, use_container_width=True)
-with c3: st.plotly_chart(fig3, use_container_width=True)
+with c1: st.plotly_chart(fig1, use_container_width=True, key="pred_move")
+with c2: st.plotly_chart(fig2, use_container_width=True, key="delta_dmin")
+with c3: st.plotly_chart(fig3, use_container_width=True, key="dmin")
 
 # =========================================================
 # UAV MAP
 # =========================================================
 st.subheader("🗺️ UAV Geographical Map")
 
-map_fig = go.Figure()
+@st.cache_resource
+def map_layout():
+    # static part of the map layout, validated once per process (read-only)
+    return go.Layout(
+        mapbox=dict(style="carto-positron", zoom=MAP_ZOOM),
+        # same revision every refresh -> plotly.js keeps the user's pan/zoom
+        uirevision="uav_map",
+        height=420,
+        margin=dict(l=0, r=0, t=30, b=0)
+    )
 
-for s, col in colors.items():
-    d = dfA[dfA["Status"] == s]
-    map_fig.add_trace(go.Scattermapbox(
-        lat=d["Y"],
-        lon=d["X"],
-        mode="markers",
-        marker=dict(size=11, color=col),
-        name=s
-    ))
+@st.cache_resource(max_entries=4)
+def map_figure(digest, _dfA, _countsA, center):
+    map_fig = go.Figure(layout=map_layout())
 
-map_fig.update_layout(
-    mapbox=dict(
-        style="open-street-map",
-        center=dict(lat=dfA["Y"].mean(), lon=dfA["X"].mean()),
-        zoom=11
-    ),
-    height=420,
-    margin=dict(l=0, r=0, t=30, b=0)
-)
+    d, c = status_points(_dfA)
+    if len(d) > CLUSTER_MIN_POINTS:
+        lat, lon, n, worst, collisions = cluster_points(d)
+        map_fig.add_trace(go.Scattermapbox(
+            lat=lat,
+            lon=lon,
+            mode="markers",
+            marker=dict(size=np.clip(11 + 4 * np.log2(n), 11, 40), color=STATUS_COLORS[worst]),
+            customdata=np.column_stack([n, collisions]),
+            hovertemplate="%{customdata[0]} UAV(s)%{customdata[1]}<extra></extra>",
+            showlegend=False
+        ))
+    elif len(d):
+        map_fig.add_trace(go.Scattermapbox(
+            lat=d["Y"].to_numpy(),
+            lon=d["X"].to_numpy(),
+            mode="markers",
+            marker=dict(size=11, color=c),
+            customdata=d[["UAV_ID", "Status"]].to_numpy(),
+            hovertemplate=HOVER_MAP,
+            showlegend=False
+        ))
+
+    for i, (s, col) in enumerate(colors.items()):
+        if _countsA[i]:
+            map_fig.add_trace(go.Scattermapbox(
+                lat=[None], lon=[None],
+                mode="markers",
+                marker=dict(size=11, color=col),
+                name=s,
+                hoverinfo="skip"
+            ))
+
+    if center is not None:
+        map_fig.update_layout(mapbox_center=dict(lat=center[0], lon=center[1]))
+
+    return map_fig
+
+# center locked on the first non-empty fleet; a moving center would undo user panning
+center = st.session_state.get("map_center")
+if center is None and len(dfA):
+    center = st.session_state["map_center"] = (
+        float(np.nanmean(dfA["Y"].to_numpy())),
+        float(np.nanmean(dfA["X"].to_numpy()))
+    )
 
-st.plotly_chart(map_fig, use_container_width=True)
+st.plotly_chart(map_figure(digest, dfA, countsA, center), use_container_width=True, key="map")
 
 # =========================================================
 # TABLES
@@ -265,9 +461,3 @@ with t1:
 with t2:
     st.markdown("**AFTER**")
     st.dataframe(dfA, use_container_width=True, height=320)
-
-# =========================================================
-# AUTO REFRESH
-# =========================================================
-time.sleep(REFRESH_SEC)
-st.rerun()